@@ -17,16 +17,33 @@
 # under the License.
 #
 
-import io
 import os
 import time
-import json
 import subprocess
-import datetime
-from shutil import copyfile
+import traceback
+from queue import Full
+from queue import Queue
+from threading import Thread
+from inotify_simple import INotify
+from inotify_simple import flags
+from functools import lru_cache
 from exception.dagda_error import DagdaError
 from log.dagda_logger import DagdaLogger
 from api.internal.internal_server import InternalServer
+try:
+    # orjson decodes the raw bytes lines much faster than the standard json module. It is optional because there
+    # are no prebuilt packages of it for the Alpine/Python 3.6 base image of the Dagda docker image
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+
+# Supported linux distributions by package format
+_RPM_DISTROS = ('Red Hat', 'CentOS', 'Fedora', 'openSUSE')
+_DEB_DISTROS = ('Debian', 'Ubuntu')
+
+# Prefixes of the sysdig/falco log lines, which start with the day of the week
+_DAY_PREFIXES = tuple(day + ' ' for day in ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun'))
 
 
 # Sysdig Falco monitor class
@@ -38,6 +55,50 @@ class SysdigFalcoMonitor:
     _tmp_directory = "/tmp"
     _falco_output_filename = _tmp_directory + '/falco_output.json'
     _falco_custom_rules_filename = _tmp_directory + '/custom_falco_rules.yaml'
+    _falco_image = 'falcosecurity/falco'
+    _falco_image_tag = '0.29.0'
+    _falco_image_name = _falco_image + ':' + _falco_image_tag
+    _falco_entrypoint = 'falco -pc -o json_output=true -o file_output.enabled=true -o file_output.filename=/host' + \
+                        _falco_output_filename + '{rules}'
+    _falco_volumes = [
+        '/host/var/run/docker.sock',
+        '/host/dev',
+        '/host/proc',
+        '/host/boot',
+        '/host/lib/modules',
+        '/host/usr',
+        '/host/etc',
+        '/host' + _tmp_directory
+    ]
+    _falco_binds = [
+        '/var/run/docker.sock:/host/var/run/docker.sock',
+        '/dev:/host/dev',
+        '/proc:/host/proc:ro',
+        '/boot:/host/boot:ro',
+        '/lib/modules:/host/lib/modules:ro',
+        '/usr:/host/usr:ro',
+        '/etc:/host/etc:ro',
+        _tmp_directory + ':/host' + _tmp_directory + ':rw'
+    ]
+    _read_chunk_size = 65536
+    _inotify_timeout = 30000
+    _bulk_insert_batch_size = 256
+    _bulk_insert_interval = 5
+    _host_container_id_field = b'"container.id":"host"'
+    _start_up_timeout = 30
+    _start_up_poll_interval = 0.25
+    _output_file_timeout = 10
+    _output_file_poll_interval = 0.05
+    _running_check_interval = 15
+    _events_queue_size = 1024
+    _exit_timeout = 30
+    # Logged by sysdig/falco once the device has been opened. Only when its embedded webserver is enabled
+    # ("webserver.enabled: true", the default), so without it the start up waits are only ended by the timeout or by
+    # the rules loaded quiet period
+    _falco_device_opened_log = 'Starting internal webserver'
+    # Logged by sysdig/falco before parsing each rules file, whatever its configuration is
+    _falco_rules_loading_log = 'Loading rules from file'
+    _start_up_quiet_period = 1
 
     # -- Public methods
 
@@ -50,30 +111,34 @@ class SysdigFalcoMonitor:
         if falco_rules_filename is None:
             self.falco_rules = ''
         else:
-            copyfile(falco_rules_filename, SysdigFalcoMonitor._falco_custom_rules_filename)
+            SysdigFalcoMonitor._copy_falco_rules_file(falco_rules_filename,
+                                                      SysdigFalcoMonitor._falco_custom_rules_filename)
             self.falco_rules = ' -o rules_file=/host' + SysdigFalcoMonitor._falco_custom_rules_filename
         if external_falco_output_filename is not None:
             InternalServer.set_external_falco(True)
             SysdigFalcoMonitor._falco_output_filename = external_falco_output_filename
+        self._external_falco = InternalServer.is_external_falco()
 
     # Pre check for Sysdig falco container
     def pre_check(self):
-        if not InternalServer.is_external_falco():
+        if not self._external_falco:
             # Init
-            linux_distro = SysdigFalcoMonitor._get_linux_distro()
+            linux_distro_family = SysdigFalcoMonitor._get_linux_distro_family()
             uname_r = os.uname().release
 
             # Check requirements
             if not os.path.isfile('/.dockerenv'):  # I'm living in real world!
-                if 'Red Hat' in linux_distro or 'CentOS' in linux_distro or 'Fedora' in linux_distro \
-                        or 'openSUSE' in linux_distro:
+                # The package manager is only queried when the headers are not in their usual location
+                if linux_distro_family == 'rpm':
                     # Red Hat/CentOS/Fedora/openSUSE
-                    return_code = subprocess.call(["rpm", "-q", "kernel-devel-" + uname_r],
-                                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-                elif 'Debian' in linux_distro or 'Ubuntu' in linux_distro:
+                    return_code = 0 if os.path.isdir('/usr/src/kernels/' + uname_r) else \
+                        subprocess.call(["rpm", "-q", "kernel-devel-" + uname_r],
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                elif linux_distro_family == 'deb':
                     # Debian/Ubuntu
-                    return_code = subprocess.call(["dpkg", "-l", "linux-headers-" + uname_r],
-                                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                    return_code = 0 if os.path.isdir('/usr/src/linux-headers-' + uname_r) else \
+                        subprocess.call(["dpkg", "-l", "linux-headers-" + uname_r],
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
                 else:
                     raise DagdaError('Linux distribution not supported yet.')
 
@@ -88,10 +153,11 @@ class SysdigFalcoMonitor:
                 raise DagdaError('Error while fetching Docker server API version.')
 
             # Docker pull for ensuring the falcosecurity/falco image
-            self.docker_driver.docker_pull('falcosecurity/falco', tag='0.29.0')
+            self.docker_driver.docker_pull(SysdigFalcoMonitor._falco_image, tag=SysdigFalcoMonitor._falco_image_tag)
 
             # Stops sysdig/falco containers if there are any
-            container_ids = self.docker_driver.get_docker_container_ids_by_image_name('falcosecurity/falco:0.29.0')
+            container_ids = self.docker_driver.get_docker_container_ids_by_image_name(
+                SysdigFalcoMonitor._falco_image_name)
             if len(container_ids) > 0:
                 for container_id in container_ids:
                     self.docker_driver.docker_stop(container_id)
@@ -103,72 +169,124 @@ class SysdigFalcoMonitor:
             # Starts sysdig running container without custom entrypoint for avoiding:
             # --> Runtime error: error opening device /host/dev/sysdig0
             self.running_container_id = self._start_container()
-            time.sleep(30)
-            logs = self.docker_driver.docker_logs(self.running_container_id, True, True, False)
-            if "Runtime error: error opening device /host/dev/sysdig0" not in logs:
-                self.docker_driver.docker_stop(self.running_container_id)
-            else:
-                raise DagdaError('Runtime error opening device /host/dev/sysdig0.')
+            self._wait_for_start_up()
+            self.docker_driver.docker_stop(self.running_container_id)
             # Clean up
             self.docker_driver.docker_remove_container(self.running_container_id)
 
     # Runs SysdigFalcoMonitor
     def run(self):
-        if not InternalServer.is_external_falco():
-            self.running_container_id = self._start_container('falco -pc -o json_output=true -o file_output.enabled=true ' +
-                                                              '-o file_output.filename=/host' +
-                                                              SysdigFalcoMonitor._falco_output_filename +
-                                                              self.falco_rules)
+        out_path = SysdigFalcoMonitor._falco_output_filename
+        if not self._external_falco:
+            self.running_container_id = self._start_container(
+                SysdigFalcoMonitor._falco_entrypoint.format(rules=self.falco_rules))
 
-            # Wait 3 seconds for sysdig/falco start up and creates the output file
-            time.sleep(3)
+            # Wait for sysdig/falco start up, so the rules parser warnings are already in its logs. The output file
+            # of a previous run may still be there, so checking the file alone is not enough
+            sysdig_falco_logs = self._wait_for_start_up(SysdigFalcoMonitor._start_up_quiet_period)
+
+            # Wait up to 10 seconds for sysdig/falco start up and creates the output file
+            deadline = time.monotonic() + SysdigFalcoMonitor._output_file_timeout
+            while not os.path.isfile(out_path) and time.monotonic() < deadline:
+                time.sleep(SysdigFalcoMonitor._output_file_poll_interval)
 
         # Check output file and running docker container
-        if not os.path.isfile(SysdigFalcoMonitor._falco_output_filename) or \
-            (not InternalServer.is_external_falco() and \
-            len(self.docker_driver.get_docker_container_ids_by_image_name('falcosecurity/falco:0.29.0')) == 0):
+        if not os.path.isfile(out_path) or \
+            (not self._external_falco and not self.docker_driver.is_running_container(self.running_container_id)):
             raise DagdaError('Falcosecurity/falco output file not found.')
 
         # Review sysdig/falco logs after rules parser
-        if not InternalServer.is_external_falco():
-            sysdig_falco_logs = self.docker_driver.docker_logs(self.running_container_id, True, True, False)
+        if not self._external_falco:
             if "Rule " in sysdig_falco_logs:
                 SysdigFalcoMonitor._parse_log_and_show_dagda_warnings(sysdig_falco_logs)
 
         # Read file
-        with open(SysdigFalcoMonitor._falco_output_filename, 'rb') as f:
-            last_file_position = 0
-            fbuf = io.BufferedReader(f)
+        fd = os.open(out_path, os.O_RDONLY | os.O_NONBLOCK)
+        # inotify lets the tail loop sleep until sysdig/falco appends new events
+        inotify = INotify()
+        inotify.add_watch(out_path, flags.MODIFY)
+        sysdig_falco_events = []
+        # MongoDB writes are done by another thread, so they do not hold back the tail loop
+        events_queue = Queue(maxsize=SysdigFalcoMonitor._events_queue_size)
+        Thread(target=self._bulk_insert_sysdig_falco_events, args=(events_queue,), daemon=True).start()
+        try:
+            chunk = bytearray(SysdigFalcoMonitor._read_chunk_size)
+            chunk_view = memoryview(chunk)
+            buf = bytearray()
+            last_flush = time.monotonic()
+            last_running_check = time.monotonic()
             while True:
-                fbuf.seek(last_file_position)
-                content = fbuf.readlines()
-                sysdig_falco_events = []
-                for line in content:
-                    falco_event = {}
-                    line = line.decode('utf-8').replace("\n", "")
-                    json_data = json.loads(line)
-                    container_id = json_data['output_fields']['container.id']
-                    if container_id != 'host':
-                        try:
-                            falco_event['container_id'] = container_id
-                            falco_event['image_name'] = json_data['output_fields']['container.image.repository']
-                            if 'container.image.tag' in json_data['output_fields']:
-                                falco_event['image_name'] += ":" + json_data['output_fields']['container.image.tag']
-                            falco_event['output'] = json_data['output']
-                            falco_event['priority'] = json_data['priority']
-                            falco_event['rule'] = json_data['rule']
-                            falco_event['time'] = json_data['time']
-                            sysdig_falco_events.append(falco_event)
-                        except IndexError:
-                            # The /tmp/falco_output.json file had information about ancient events, so nothing to do
-                            pass
-                        except KeyError:
-                            # The /tmp/falco_output.json file had information about ancient events, so nothing to do
-                            pass
-                last_file_position = fbuf.tell()
+                # Drain the new bytes appended by sysdig/falco since the last poll. They are read into the same
+                # chunk buffer every time, so no bytes object is allocated per read
+                read_bytes = os.readv(fd, [chunk])
+                while read_bytes > 0:
+                    buf += chunk_view[:read_bytes]
+                    read_bytes = os.readv(fd, [chunk])
+                # All the complete lines are split at once. The last item is the trailing partial line, if any,
+                # which is kept for the next poll
+                lines = buf.split(b'\n')
+                buf = lines.pop()
+                for line in lines:
+                    # Host events are discarded before paying for the JSON parsing
+                    if not line or SysdigFalcoMonitor._host_container_id_field in line:
+                        continue
+                    json_data = json_loads(line)
+                    output_fields = json_data.get('output_fields')
+                    if not output_fields:
+                        continue
+                    container_id = output_fields.get('container.id')
+                    image_name = output_fields.get('container.image.repository')
+                    if container_id is None or container_id == 'host' or image_name is None:
+                        # The /tmp/falco_output.json file had information about ancient events, so nothing to do
+                        continue
+                    output = json_data.get('output')
+                    priority = json_data.get('priority')
+                    rule = json_data.get('rule')
+                    event_time = json_data.get('time')
+                    if output is None or priority is None or rule is None or event_time is None:
+                        # E.g. an external sysdig/falco with "json_include_output_property: false", so nothing to do
+                        continue
+                    image_tag = output_fields.get('container.image.tag')
+                    sysdig_falco_events.append({
+                        'container_id': container_id,
+                        'image_name': image_name if image_tag is None else image_name + ':' + image_tag,
+                        'output': output,
+                        'priority': priority,
+                        'rule': rule,
+                        'time': event_time
+                    })
+                # Bulk insert in batches, flushing at least every few seconds while there are pending events
+                if len(sysdig_falco_events) > 0 and \
+                        (len(sysdig_falco_events) >= SysdigFalcoMonitor._bulk_insert_batch_size or
+                         time.monotonic() - last_flush >= SysdigFalcoMonitor._bulk_insert_interval):
+                    SysdigFalcoMonitor._enqueue_sysdig_falco_events(events_queue, sysdig_falco_events)
+                    sysdig_falco_events = []
+                    last_flush = time.monotonic()
+                # Check from time to time that the sysdig/falco container is still alive
+                if not self._external_falco and \
+                        time.monotonic() - last_running_check >= SysdigFalcoMonitor._running_check_interval:
+                    if not self.docker_driver.is_running_container(self.running_container_id):
+                        raise DagdaError('Falcosecurity/falco container is not running.')
+                    last_running_check = time.monotonic()
+                # Wait until sysdig/falco writes again. The timeout is a safety net for missed notifications
+                # and it is shortened while there are pending events, so they are not held back too long
                 if len(sysdig_falco_events) > 0:
-                    self.mongodb_driver.bulk_insert_sysdig_falco_events(sysdig_falco_events)
-                time.sleep(2)
+                    timeout = SysdigFalcoMonitor._bulk_insert_interval * 1000
+                else:
+                    timeout = SysdigFalcoMonitor._inotify_timeout
+                inotify.read(timeout=timeout)
+        finally:
+            # Whatever the exit reason is, the pending events are still bulk inserted before leaving, because the
+            # MongoDB writer is a daemon thread. The wait is bounded, so a stuck MongoDB can not block the exit
+            deadline = time.monotonic() + SysdigFalcoMonitor._exit_timeout
+            if len(sysdig_falco_events) > 0:
+                try:
+                    events_queue.put(sysdig_falco_events, timeout=SysdigFalcoMonitor._exit_timeout)
+                except Full:
+                    pass
+            SysdigFalcoMonitor._wait_for_sysdig_falco_events_insertion(events_queue, deadline)
+            inotify.close()
+            os.close(fd)
 
     # Gets running container id
     def get_running_container_id(self):
@@ -179,57 +297,137 @@ class SysdigFalcoMonitor:
     # Starts Sysdig falco container
     def _start_container(self, entrypoint=None):
         # Start container
-        container_id = self.docker_driver.create_container('falcosecurity/falco:0.29.0',
+        container_id = self.docker_driver.create_container(SysdigFalcoMonitor._falco_image_name,
                                                            entrypoint,
-                                                           [
-                                                              '/host/var/run/docker.sock',
-                                                              '/host/dev',
-                                                              '/host/proc',
-                                                              '/host/boot',
-                                                              '/host/lib/modules',
-                                                              '/host/usr',
-                                                              '/host/etc',
-                                                              '/host' + SysdigFalcoMonitor._tmp_directory
-                                                           ],
+                                                           SysdigFalcoMonitor._falco_volumes,
                                                            self.docker_driver.get_docker_client().create_host_config(
-                                                              binds=[
-                                                                  '/var/run/docker.sock:/host/var/run/docker.sock',
-                                                                  '/dev:/host/dev',
-                                                                  '/proc:/host/proc:ro',
-                                                                  '/boot:/host/boot:ro',
-                                                                  '/lib/modules:/host/lib/modules:ro',
-                                                                  '/usr:/host/usr:ro',
-                                                                  '/etc:/host/etc:ro',
-                                                                  SysdigFalcoMonitor._tmp_directory + ':/host' +
-                                                                            SysdigFalcoMonitor._tmp_directory + ':rw'
-                                                              ],
+                                                              binds=SysdigFalcoMonitor._falco_binds,
                                                               privileged=True))
         self.docker_driver.docker_start(container_id)
         return container_id
 
+    # Polls the sysdig/falco container logs until it fails opening the device, gets past it or the timeout expires.
+    # With quiet_period, it also returns once the rules are being loaded and the logs have not changed for that
+    # period, so the rules parser warnings are already in them
+    def _wait_for_start_up(self, quiet_period=None):
+        deadline = time.monotonic() + SysdigFalcoMonitor._start_up_timeout
+        last_logs = None
+        last_change = time.monotonic()
+        while True:
+            logs = self.docker_driver.docker_logs(self.running_container_id, True, True, False)
+            if "Runtime error: error opening device /host/dev/sysdig0" in logs:
+                raise DagdaError('Runtime error opening device /host/dev/sysdig0.')
+            now = time.monotonic()
+            if SysdigFalcoMonitor._falco_device_opened_log in logs or now >= deadline:
+                return logs
+            if logs != last_logs:
+                last_logs = logs
+                last_change = now
+            elif quiet_period is not None and SysdigFalcoMonitor._falco_rules_loading_log in logs and \
+                    now - last_change >= quiet_period:
+                return logs
+            time.sleep(SysdigFalcoMonitor._start_up_poll_interval)
+
+    # Bulk inserts the sysdig/falco events batches enqueued by the tail loop
+    def _bulk_insert_sysdig_falco_events(self, events_queue):
+        while True:
+            sysdig_falco_events = events_queue.get()
+            try:
+                self.mongodb_driver.bulk_insert_sysdig_falco_events(sysdig_falco_events)
+            except Exception as ex:
+                message = "Unexpected exception of type {0} occurred: {1!r}".format(type(ex).__name__, ex.args)
+                DagdaLogger.get_logger().error(message)
+                if InternalServer.is_debug_logging_enabled():
+                    traceback.print_exc()
+            finally:
+                events_queue.task_done()
+
     # -- Private & static methods
 
+    # Waits until the MongoDB writer has inserted all the enqueued batches or the deadline is reached
+    @staticmethod
+    def _wait_for_sysdig_falco_events_insertion(events_queue, deadline):
+        with events_queue.all_tasks_done:
+            while events_queue.unfinished_tasks:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    DagdaLogger.get_logger().warning('Timeout while bulk inserting the pending sysdig/falco events. '
+                                                     'Some of them are lost.')
+                    return
+                events_queue.all_tasks_done.wait(remaining)
+
+    # Enqueues a sysdig/falco events batch, waiting for the MongoDB writer if it is falling behind
+    @staticmethod
+    def _enqueue_sysdig_falco_events(events_queue, sysdig_falco_events):
+        try:
+            events_queue.put_nowait(sysdig_falco_events)
+        except Full:
+            DagdaLogger.get_logger().warning('MongoDB is falling behind sysdig/falco events. Waiting for it.')
+            events_queue.put(sysdig_falco_events)
+
     # Parse sysdig/falco logs after rules parser
     @staticmethod
     def _parse_log_and_show_dagda_warnings(sysdig_falco_logs):
-        date_prefix = datetime.datetime.now().strftime("%A")[:3] + ' '
-        lines = sysdig_falco_logs.split("\n")
-        warning = ''
+        lines = sysdig_falco_logs.splitlines()
+        warning_lines = []
         for line in lines:
-            if line.startswith(date_prefix) is not True:
+            if line.startswith(_DAY_PREFIXES) is not True:
                 line = line.strip()
                 if line.startswith('Rule '):
-                    if warning:
-                        DagdaLogger.get_logger().warning(warning.strip())
-                    warning = ''
-                warning+=' ' + line
+                    if warning_lines:
+                        DagdaLogger.get_logger().warning(' '.join(warning_lines).strip())
+                    warning_lines = []
+                warning_lines.append(line)
+        if warning_lines:
+            DagdaLogger.get_logger().warning(' '.join(warning_lines).strip())
+
+    # Copies the custom rules file, as a hard link when both paths are in the same filesystem
+    @staticmethod
+    def _copy_falco_rules_file(src, dst):
+        if os.path.exists(dst) and os.path.samefile(src, dst):
+            return
+        # The new copy is made next to the destination and moved into place, so the previous copy is never written
+        # through. It could be a hard link to a former rules file
+        tmp_dst = dst + '.tmp'
+        try:
+            os.unlink(tmp_dst)
+        except FileNotFoundError:
+            pass
+        try:
+            os.link(src, tmp_dst)
+        except OSError:
+            with open(src, 'rb') as fsrc, open(tmp_dst, 'wb') as fdst:
+                size = os.fstat(fsrc.fileno()).st_size
+                offset = 0
+                while offset < size:
+                    sent = os.sendfile(fdst.fileno(), fsrc.fileno(), offset, size - offset)
+                    if sent == 0:
+                        break
+                    offset += sent
+        os.replace(tmp_dst, dst)
 
     # Avoids the "platform.linux_distribution()" method which is deprecated in Python 3.5
     @staticmethod
+    @lru_cache(maxsize=1)
     def _get_linux_distro():
-        with open('/etc/os-release', 'r') as f:
-            lines = f.readlines()
-        for line in lines:
-            if line.startswith('NAME='):
-                name = line.replace('NAME=', '').replace("\n", '').replace("'", '').replace('"', '')
-                return name
+        with open('/etc/os-release', 'rb') as f:
+            data = b'\n' + f.read() + b'\n'
+        start = data.find(b'\nNAME=')
+        if start == -1:
+            return None
+        start += len(b'\nNAME=')
+        end = data.find(b'\n', start)
+        return data[start:end].strip().strip(b'"\'').decode('utf-8')
+
+    # Gets the package format ('rpm' or 'deb') of the linux distribution, or None if it is not supported
+    @staticmethod
+    @lru_cache(maxsize=1)
+    def _get_linux_distro_family():
+        linux_distro = SysdigFalcoMonitor._get_linux_distro()
+        if linux_distro is None:
+            return None
+        if any(distro in linux_distro for distro in _RPM_DISTROS):
+            return 'rpm'
+        if any(distro in linux_distro for distro in _DEB_DISTROS):
+            return 'deb'
+        return None
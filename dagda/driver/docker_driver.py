@@ -57,6 +57,11 @@ class DockerDriver:
             pass
         return ids
 
+    # Checks if the docker container is running
+    def is_running_container(self, container_id):
+        containers = self.cli.containers(filters={'id': container_id})
+        return len(containers) > 0
+
     # Checks if docker image is in the local machine
     def is_docker_image(self, image_name):
         image = self.cli.images(name=image_name)
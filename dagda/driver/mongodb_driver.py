@@ -136,22 +136,16 @@ class MongoDbDriver:
         self.db.docker_events.create_index([('Type', pymongo.DESCENDING)])
         self.db.docker_events.insert_many(events)
 
-    # Bulk insert the sysdig/falco events
+    # Bulk insert the sysdig/falco events. The events are taken over by this method: their time string is replaced
+    # in place by its timestamp and pymongo adds the '_id' field, so the same events must not be inserted again
     def bulk_insert_sysdig_falco_events(self, events):
-        sysdig_falco_events = []
+        # The events already have the stored document fields, so only the time is converted
         for event in events:
-            data = {}
-            data['container_id'] = event['container_id']
-            data['image_name'] = event['image_name']
-            data['priority'] = event['priority']
-            data['time'] = dateutil.parser.parse(event['time']).timestamp()
-            data['rule'] = event['rule']
-            data['output'] = event['output']
-            sysdig_falco_events.append(data)
+            event['time'] = dateutil.parser.parse(event['time']).timestamp()
         # Bulk insert
         if self.db.falco_events.count() == 0:
             self.db.falco_events.create_index([('container_id', pymongo.DESCENDING)])
-        self.db.falco_events.insert_many(sysdig_falco_events)
+        self.db.falco_events.insert_many(events)
 
     # Inserts the docker image scan result to history
     def insert_docker_image_scan_result_to_history(self, scan_result):
@@ -0,0 +1,283 @@
+#
+# Licensed to Dagda under one or more contributor
+# license agreements. See the NOTICE file distributed with
+# this work for additional information regarding copyright
+# ownership. Dagda licenses this file to you under
+# the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+import os
+import json
+import time
+import tempfile
+import unittest
+from queue import Queue
+from unittest.mock import Mock
+from unittest.mock import mock_open
+from unittest.mock import patch
+from analysis.runtime.sysdig_falco_monitor import SysdigFalcoMonitor
+from api.internal.internal_server import InternalServer
+from exception.dagda_error import DagdaError
+
+
+# -- Test suite
+
+class SysdigFalcoMonitorTestCase(unittest.TestCase):
+
+    falco_rules_filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../mock_files/falco_rules.yaml')
+
+    def setUp(self):
+        SysdigFalcoMonitor._get_linux_distro.cache_clear()
+        SysdigFalcoMonitor._get_linux_distro_family.cache_clear()
+
+    def tearDown(self):
+        SysdigFalcoMonitor._get_linux_distro.cache_clear()
+        SysdigFalcoMonitor._get_linux_distro_family.cache_clear()
+
+    def test_get_linux_distro(self):
+        with patch('builtins.open', mock_open(read_data=b'PRETTY_NAME="Debian GNU/Linux 10 (buster)"\n'
+                                                        b'NAME="Debian GNU/Linux"\nVERSION_ID="10"\n')):
+            self.assertEqual(SysdigFalcoMonitor._get_linux_distro(), 'Debian GNU/Linux')
+
+    def test_get_linux_distro_without_quotes_and_final_new_line(self):
+        with patch('builtins.open', mock_open(read_data=b'ID=fedora\nNAME=Fedora')):
+            self.assertEqual(SysdigFalcoMonitor._get_linux_distro(), 'Fedora')
+
+    def test_get_linux_distro_without_name(self):
+        with patch('builtins.open', mock_open(read_data=b'ID=alpine\n')):
+            self.assertIsNone(SysdigFalcoMonitor._get_linux_distro())
+
+    def test_get_linux_distro_family_rpm(self):
+        with patch('builtins.open', mock_open(read_data=b"NAME='CentOS Linux'\n")):
+            self.assertEqual(SysdigFalcoMonitor._get_linux_distro_family(), 'rpm')
+
+    def test_get_linux_distro_family_deb(self):
+        with patch('builtins.open', mock_open(read_data=b'NAME="Ubuntu"\n')):
+            self.assertEqual(SysdigFalcoMonitor._get_linux_distro_family(), 'deb')
+
+    def test_get_linux_distro_family_not_supported(self):
+        with patch('builtins.open', mock_open(read_data=b'NAME="Alpine Linux"\n')):
+            self.assertIsNone(SysdigFalcoMonitor._get_linux_distro_family())
+
+    def test_parse_log_and_show_dagda_warnings(self):
+        logs = 'Wed Oct 14 23:59:59 2026: Falco initialized with configuration file /etc/falco/falco.yaml\n' + \
+               'Thu Oct 15 00:00:00 2026: Loading rules from file /etc/falco/falco_rules.yaml:\n' + \
+               'Rule Rule1: warning (no-evttype):\n' + \
+               '  proc.name=foo\n' + \
+               'Rule Rule2: warning (no-evttype):\n' + \
+               '  proc.name=bar\n'
+        with self.assertLogs('DagdaLogger', level='WARNING') as cm:
+            SysdigFalcoMonitor._parse_log_and_show_dagda_warnings(logs)
+        self.assertEqual(cm.output, ['WARNING:DagdaLogger:Rule Rule1: warning (no-evttype): proc.name=foo',
+                                     'WARNING:DagdaLogger:Rule Rule2: warning (no-evttype): proc.name=bar'])
+
+    def test_copy_falco_rules_file(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            old_rules = os.path.join(tmp_dir, 'old_rules.yaml')
+            new_rules = os.path.join(tmp_dir, 'new_rules.yaml')
+            custom_rules = os.path.join(tmp_dir, 'custom_rules.yaml')
+            with open(old_rules, 'w') as f:
+                f.write('- rule: old')
+            with open(new_rules, 'w') as f:
+                f.write('- rule: new')
+            SysdigFalcoMonitor._copy_falco_rules_file(old_rules, custom_rules)
+            SysdigFalcoMonitor._copy_falco_rules_file(new_rules, custom_rules)
+            with open(custom_rules) as f:
+                self.assertEqual(f.read(), '- rule: new')
+            with open(old_rules) as f:
+                self.assertEqual(f.read(), '- rule: old')
+
+    def test_copy_falco_rules_file_to_itself(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            rules = os.path.join(tmp_dir, 'rules.yaml')
+            with open(rules, 'w') as f:
+                f.write('- rule: same')
+            SysdigFalcoMonitor._copy_falco_rules_file(rules, rules)
+            with open(rules) as f:
+                self.assertEqual(f.read(), '- rule: same')
+            self.assertEqual(os.listdir(tmp_dir), ['rules.yaml'])
+
+    def test_copy_falco_rules_file_without_hard_link(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            custom_rules = os.path.join(tmp_dir, 'custom_rules.yaml')
+            with patch('os.link', side_effect=OSError):
+                SysdigFalcoMonitor._copy_falco_rules_file(self.falco_rules_filename, custom_rules)
+            with open(self.falco_rules_filename, 'rb') as expected, open(custom_rules, 'rb') as f:
+                self.assertEqual(f.read(), expected.read())
+
+    def test_wait_for_start_up_with_device_opened(self):
+        logs = 'Loading rules from file /etc/falco/falco_rules.yaml:\nStarting internal webserver, listening on port 8765\n'
+        monitor = self._new_start_up_monitor(logs)
+        self.assertEqual(monitor._wait_for_start_up(), logs)
+
+    def test_wait_for_start_up_with_device_error(self):
+        monitor = self._new_start_up_monitor('Runtime error: error opening device /host/dev/sysdig0. Exiting.\n')
+        with self.assertRaises(DagdaError):
+            monitor._wait_for_start_up()
+
+    def test_wait_for_start_up_with_rules_loaded_quiet_period(self):
+        logs = 'Loading rules from file /etc/falco/falco_rules.yaml:\nRule Rule1: warning (no-evttype):\n'
+        monitor = self._new_start_up_monitor(logs)
+        with patch.object(SysdigFalcoMonitor, '_start_up_poll_interval', 0.01), \
+                patch.object(SysdigFalcoMonitor, '_start_up_timeout', 10):
+            start = time.monotonic()
+            self.assertEqual(monitor._wait_for_start_up(0.05), logs)
+        self.assertLess(time.monotonic() - start, 5)
+
+    def test_run_with_line_split_across_reads(self):
+        first_event = falco_event('ef45au6756jh')
+        second_event = falco_event('a1b2c3d4e5f6')
+        events = self._run([first_event + '\n' + second_event[:40], second_event[40:] + '\n'])
+        self.assertEqual([event['container_id'] for event in events], ['ef45au6756jh', 'a1b2c3d4e5f6'])
+        self.assertEqual(events[0], {'container_id': 'ef45au6756jh', 'image_name': 'alpine:3.6',
+                                     'output': 'Sensitive file opened for reading by non-trusted program',
+                                     'priority': 'Warning', 'rule': 'read_sensitive_file_untrusted',
+                                     'time': '2016-06-06T23:47:44.080226697Z'})
+
+    def test_run_skips_host_events(self):
+        events = self._run([falco_event('host') + '\n' + falco_event('ef45au6756jh') + '\n'])
+        self.assertEqual([event['container_id'] for event in events], ['ef45au6756jh'])
+
+    def test_run_with_null_tag(self):
+        events = self._run([falco_event('ef45au6756jh', tag=None) + '\n'])
+        self.assertEqual(events[0]['image_name'], 'alpine')
+
+    def test_run_skips_events_without_repository(self):
+        events = self._run([falco_event('ef45au6756jh', repository=None) + '\n' +
+                            falco_event('a1b2c3d4e5f6') + '\n'])
+        self.assertEqual([event['container_id'] for event in events], ['a1b2c3d4e5f6'])
+
+    def test_run_skips_events_without_output(self):
+        event_without_output = json.loads(falco_event('ef45au6756jh'))
+        del event_without_output['output']
+        events = self._run([json.dumps(event_without_output, separators=(',', ':')) + '\n' +
+                            falco_event('a1b2c3d4e5f6') + '\n'])
+        self.assertEqual([event['container_id'] for event in events], ['a1b2c3d4e5f6'])
+
+    def test_run_flushes_on_interval(self):
+        events = self._run([falco_event('ef45au6756jh') + '\n', falco_event('a1b2c3d4e5f6') + '\n'],
+                           bulk_insert_batch_size=1000)
+        self.assertEqual(self.mongodb_driver.bulk_insert_sysdig_falco_events.call_count, 2)
+        self.assertEqual([event['container_id'] for event in events], ['ef45au6756jh', 'a1b2c3d4e5f6'])
+
+    def test_run_flushes_on_batch_size(self):
+        events = self._run([falco_event('ef45au6756jh') + '\n',
+                            falco_event('a1b2c3d4e5f6') + '\n' + falco_event('f6e5d4c3b2a1') + '\n'],
+                           bulk_insert_interval=3600, bulk_insert_batch_size=2)
+        self.mongodb_driver.bulk_insert_sysdig_falco_events.assert_called_once()
+        self.assertEqual([event['container_id'] for event in events], ['ef45au6756jh', 'a1b2c3d4e5f6',
+                                                                       'f6e5d4c3b2a1'])
+
+    def test_run_holds_events_before_interval_and_batch_size(self):
+        events = self._run([falco_event('ef45au6756jh') + '\n', falco_event('a1b2c3d4e5f6') + '\n'],
+                           bulk_insert_interval=3600)
+        # Both events are held by the tail loop and only bulk inserted when it exits
+        self.mongodb_driver.bulk_insert_sysdig_falco_events.assert_called_once()
+        self.assertEqual([event['container_id'] for event in events], ['ef45au6756jh', 'a1b2c3d4e5f6'])
+
+    def test_run_inserts_held_events_on_keyboard_interrupt(self):
+        events = self._run([falco_event('ef45au6756jh') + '\n'], bulk_insert_interval=3600,
+                           stop_exception=KeyboardInterrupt)
+        self.assertEqual([event['container_id'] for event in events], ['ef45au6756jh'])
+
+    def test_run_with_falco_container_not_running(self):
+        docker_driver = Mock()
+        docker_driver.docker_logs.return_value = 'Starting internal webserver, listening on port 8765\n'
+        docker_driver.is_running_container.side_effect = [True, False]
+        with patch.object(SysdigFalcoMonitor, '_running_check_interval', 0):
+            events = self._run([falco_event('ef45au6756jh') + '\n'], bulk_insert_interval=3600,
+                               expected_exception=DagdaError, docker_driver=docker_driver)
+        self.assertEqual(self.exception.get_message(), 'Falcosecurity/falco container is not running.')
+        self.assertEqual(docker_driver.is_running_container.call_count, 2)
+        # The pending events are still bulk inserted
+        self.assertEqual([event['container_id'] for event in events], ['ef45au6756jh'])
+
+    # -- Private methods
+
+    # Gets a monitor whose sysdig/falco container always returns the same logs
+    def _new_start_up_monitor(self, logs):
+        docker_driver = Mock()
+        docker_driver.docker_logs.return_value = logs
+        return SysdigFalcoMonitor(docker_driver, Mock(), None, None)
+
+    # Runs the monitor against an output file. The first write is in the file before starting and each one of the
+    # others is appended when the monitor waits for new events, which is stopped after the last one with
+    # stop_exception. The output file is external unless a docker_driver is given. Returns the bulk inserted events
+    def _run(self, writes, bulk_insert_interval=0, bulk_insert_batch_size=256, stop_exception=None,
+             expected_exception=None, docker_driver=None):
+        self.mongodb_driver = Mock()
+        stop_exception = stop_exception or StopRun
+        expected_exception = expected_exception or stop_exception
+        queues = []
+
+        def new_queue(maxsize):
+            events_queue = Queue(maxsize=maxsize)
+            queues.append(events_queue)
+            return events_queue
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output_filename = os.path.join(tmp_dir, 'falco_output.json')
+            with open(output_filename, 'w') as f:
+                f.write(writes[0])
+            pending_writes = list(writes[1:])
+
+            def inotify_read(timeout):
+                if not pending_writes:
+                    raise stop_exception()
+                with open(output_filename, 'a') as f:
+                    f.write(pending_writes.pop(0))
+                return []
+
+            with patch.object(InternalServer, '_external_falco', False), \
+                    patch.object(SysdigFalcoMonitor, '_falco_output_filename',
+                                 SysdigFalcoMonitor._falco_output_filename), \
+                    patch.object(SysdigFalcoMonitor, '_bulk_insert_interval', bulk_insert_interval), \
+                    patch.object(SysdigFalcoMonitor, '_bulk_insert_batch_size', bulk_insert_batch_size), \
+                    patch('analysis.runtime.sysdig_falco_monitor.Queue', side_effect=new_queue), \
+                    patch('analysis.runtime.sysdig_falco_monitor.INotify') as inotify:
+                inotify.return_value.read.side_effect = inotify_read
+                monitor = SysdigFalcoMonitor(docker_driver or Mock(), self.mongodb_driver, None, output_filename)
+                if docker_driver is not None:
+                    # Runs as if the sysdig/falco container was started by Dagda
+                    monitor._external_falco = False
+                with self.assertRaises(expected_exception) as cm:
+                    monitor.run()
+                self.exception = cm.exception
+        # Waits for the MongoDB writer thread
+        queues[0].join()
+        events = []
+        for call in self.mongodb_driver.bulk_insert_sysdig_falco_events.call_args_list:
+            events.extend(call[0][0])
+        return events
+
+
+# -- Util classes & functions
+
+class StopRun(Exception):
+    pass
+
+
+def falco_event(container_id, repository='alpine', tag='3.6'):
+    output_fields = {'container.id': container_id}
+    if repository is not None:
+        output_fields['container.image.repository'] = repository
+        output_fields['container.image.tag'] = tag
+    return json.dumps({'output': 'Sensitive file opened for reading by non-trusted program',
+                       'priority': 'Warning', 'rule': 'read_sensitive_file_untrusted',
+                       'time': '2016-06-06T23:47:44.080226697Z', 'output_fields': output_fields},
+                      separators=(',', ':'))
+
+
+if __name__ == '__main__':
+    unittest.main()
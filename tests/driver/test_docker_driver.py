@@ -0,0 +1,49 @@
+#
+# Licensed to Dagda under one or more contributor
+# license agreements. See the NOTICE file distributed with
+# this work for additional information regarding copyright
+# ownership. Dagda licenses this file to you under
+# the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+import unittest
+from unittest.mock import Mock
+from driver.docker_driver import DockerDriver
+
+
+# -- Test suite
+
+class DockerDriverTestCase(unittest.TestCase):
+
+    def test_is_running_container(self):
+        mock_driver = MockDockerDriver([{'Id': 'ef45au6756jh', 'Image': 'falcosecurity/falco:0.29.0'}])
+        self.assertTrue(mock_driver.is_running_container('ef45au6756jh'))
+        mock_driver.cli.containers.assert_called_once_with(filters={'id': 'ef45au6756jh'})
+
+    def test_is_not_running_container(self):
+        mock_driver = MockDockerDriver([])
+        self.assertFalse(mock_driver.is_running_container('ef45au6756jh'))
+        mock_driver.cli.containers.assert_called_once_with(filters={'id': 'ef45au6756jh'})
+
+
+# -- Mock classes
+
+class MockDockerDriver(DockerDriver):
+    def __init__(self, containers):
+        self.cli = Mock()
+        self.cli.containers.return_value = containers
+
+
+if __name__ == '__main__':
+    unittest.main()